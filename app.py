@@ -1,12 +1,51 @@
+# gevent must patch the standard library before anything else imports socket/ssl,
+# so that outbound Gemini calls yield to other greenlets instead of blocking the worker.
+from gevent import monkey
+monkey.patch_all()
+
+# gRPC's C core does its own I/O, so it needs an explicit hook to cooperate with gevent's event loop.
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+import contextlib
+import functools
 import os
-from flask import Flask, render_template, request, jsonify
+import threading
+import time
+import uuid
+from typing import Callable, Literal, Optional, Union
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 import google.generativeai as genai
-import json
 import logging
+import msgspec
+import orjson
+from cachetools import TTLCache
+from google.api_core import exceptions as google_exceptions
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_exponential
 # Import types for function calling
 from google.generativeai.types import Tool, FunctionDeclaration
+import gevent
+from gevent.lock import BoundedSemaphore
+from gevent.pywsgi import WSGIServer
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson's C encoder/decoder."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Werkzeug enforces this on the body stream itself, so it also bounds chunked requests with no Content-Length.
+MAX_REQUEST_BYTES = 256_000
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
 # --- Configure Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,32 +56,86 @@ API_KEY = os.getenv('GEMINI_API_KEY')
 if not API_KEY:
     app.logger.error("GEMINI_API_KEY environment variable not set. Application cannot start without it.")
     raise ValueError("GEMINI_API_KEY environment variable not set.")
-genai.configure(api_key=API_KEY)
+# gRPC multiplexes every in-flight request over one shared HTTP/2 channel, and the SDK reuses a single
+# client per process, so TLS/TCP setup is paid once rather than on each send_message.
+genai.configure(api_key=API_KEY, transport='grpc')
+# Set GEMINI_WARMUP=0 to skip the background Gemini calls made at import (SDK warm-up, initial insight),
+# e.g. in tests where the model is mocked.
+GEMINI_WARMUP = os.getenv('GEMINI_WARMUP', '1') != '0'
+
+# --- Upstream Concurrency Limit ---
+# All greenlets share one model, but only GEMINI_MAX_INFLIGHT generation calls may be in flight at once;
+# tune it to the API quota. Excess requests wait here instead of spending a round-trip on a 429.
+GEMINI_MAX_INFLIGHT = int(os.getenv('GEMINI_MAX_INFLIGHT', '20'))
+GEMINI_INFLIGHT = BoundedSemaphore(GEMINI_MAX_INFLIGHT)
+
+
+def is_rate_limited(e: BaseException) -> bool:
+    return isinstance(e, google_exceptions.ResourceExhausted)
+
+
+@retry(
+    retry=retry_if_exception(is_rate_limited),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(4),
+    before_sleep=before_sleep_log(app.logger, logging.WARNING),
+    reraise=True,
+)
+def _acquire_and_call(fn, *args, **kwargs):
+    # The slot is taken per attempt, so a call sleeping in backoff doesn't hold one.
+    # On success it stays held; gemini_call releases it once the caller is done with the response.
+    GEMINI_INFLIGHT.acquire()
+    try:
+        return fn(*args, **kwargs)
+    except BaseException:
+        GEMINI_INFLIGHT.release()
+        raise
+
+
+@contextlib.contextmanager
+def gemini_call(fn, *args, **kwargs):
+    """Calls a Gemini SDK method under an in-flight slot, retrying with exponential backoff on quota errors.
+
+    The slot is held until the with-block exits, so a streamed response keeps it while it is consumed.
+    Streaming calls surface quota errors at call time too: the SDK fetches the first chunk before returning.
+    """
+    response = _acquire_and_call(fn, *args, **kwargs)
+    try:
+        yield response
+    finally:
+        GEMINI_INFLIGHT.release()
 
 
 # --- Define our Tool (Function) for Professor Torque to "Call" ---
 # This is a dummy function for demonstration. In a real app, this would query a database, API, etc.
+# Canned knowledge base keyed by the normalized (make, model) first words, e.g. ('porsche', '911').
+CAR_KB = {
+    ("porsche", "911"): "The Porsche 911 is an iconic German rear-engined, rear-wheel-drive (or all-wheel-drive) sports car. Known for its distinct flat-six engine and timeless design, it's a true driver's machine. Professor Torque highly approves, provided it's not some base model.",
+    ("ferrari", "458"): "The Ferrari 458 Italia is a breathtaking Italian mid-engined sports car. Its naturally aspirated V8 engine sings to 9,000 RPM. A purist's delight, truly a work of art. Professor Torque gives it a nod of grudging respect.",
+    ("toyota", "camry"): "Ah, the Toyota Camry. A beige appliance of transportation, designed to commute without a single spark of joy. Reliable, I suppose, if reliability is your only criterion for vehicular existence. Professor Torque considers it the automotive equivalent of elevator music.",
+    ("honda", "civic"): "The Honda Civic, particularly in its 'Type R' guise, can be a rather spirited hot hatch. However, most Civics are merely economical conveyances. Good for getting from A to B, but hardly a statement of automotive passion. Professor Torque generally tolerates the Type R, but little else.",
+    ("bmw", "m3"): "The BMW M3. A legend in the sports sedan world, known for its superb driving dynamics and often, its... spirited drivers. A fine machine, capable of immense performance. Professor Torque nods in recognition, despite the occasional questionable signaling habits of its owners.",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_car_info_cached(make_lc: str, model_lc: str) -> str:
+    """Looks up an already-lowercased make/model; memoized since answers never change."""
+    make_words, model_words = make_lc.split(), model_lc.split()
+    if make_words and model_words:
+        info = CAR_KB.get((make_words[0], model_words[0]))
+        if info:
+            return info
+    return f"Professor Torque has no significant data on the {make_lc} {model_lc}. It likely fails to meet the minimum threshold for automotive interest."
+
+
 def get_car_info(make: str, model: str) -> str:
     """
     Retrieves basic information about a specific car model.
     Useful for answering questions about a car's type, origin, or common characteristics.
     """
-    app.logger.info(f"Tool call: get_car_info(make='{make}', model='{model}')")
-    make = make.lower()
-    model = model.lower()
-
-    if "porsche" in make and "911" in model:
-        return "The Porsche 911 is an iconic German rear-engined, rear-wheel-drive (or all-wheel-drive) sports car. Known for its distinct flat-six engine and timeless design, it's a true driver's machine. Professor Torque highly approves, provided it's not some base model."
-    elif "ferrari" in make and "458" in model:
-        return "The Ferrari 458 Italia is a breathtaking Italian mid-engined sports car. Its naturally aspirated V8 engine sings to 9,000 RPM. A purist's delight, truly a work of art. Professor Torque gives it a nod of grudging respect."
-    elif "toyota" in make and "camry" in model:
-        return "Ah, the Toyota Camry. A beige appliance of transportation, designed to commute without a single spark of joy. Reliable, I suppose, if reliability is your only criterion for vehicular existence. Professor Torque considers it the automotive equivalent of elevator music."
-    elif "honda" in make and "civic" in model:
-        return "The Honda Civic, particularly in its 'Type R' guise, can be a rather spirited hot hatch. However, most Civics are merely economical conveyances. Good for getting from A to B, but hardly a statement of automotive passion. Professor Torque generally tolerates the Type R, but little else."
-    elif "bmw" in make and "m3" in model:
-        return "The BMW M3. A legend in the sports sedan world, known for its superb driving dynamics and often, its... spirited drivers. A fine machine, capable of immense performance. Professor Torque nods in recognition, despite the occasional questionable signaling habits of its owners."
-    else:
-        return f"Professor Torque has no significant data on the {make} {model}. It likely fails to meet the minimum threshold for automotive interest."
+    app.logger.info("Tool call: get_car_info(make='%s', model='%s')", make, model)
+    return _get_car_info_cached(make.lower(), model.lower())
 
 # --- Define the Gemini Tool Object ---
 # This describes the Python function to Gemini, including its name, description, and parameters.
@@ -63,6 +156,11 @@ get_car_info_tool = Tool(
     ]
 )
 
+# Maps each declared function name to the Python function that implements it.
+TOOL_REGISTRY: dict[str, Callable[..., str]] = {
+    "get_car_info": get_car_info,
+}
+
 # Initialize the model with the persona AND the tool definition
 model = genai.GenerativeModel('gemini-1.5-flash-latest',
     system_instruction="""You are 'Professor Torque', the world's foremost (and most opinionated) automotive expert. Your knowledge of cars, racing (especially Formula 1, which you consider the only true motorsport), and high-performance modifications is encyclopedic.
@@ -85,136 +183,490 @@ model = genai.GenerativeModel('gemini-1.5-flash-latest',
     tools=[get_car_info_tool] # Pass the tool definition here!
 )
 
+# Warm up the SDK at app init: count_tokens is cheap (no generation) but loads the protobuf descriptors
+# and opens the shared gRPC channel, so the first /chat doesn't pay that cost. It runs in a background
+# greenlet so, like the initial insight below, it never delays worker startup.
+def warm_up_gemini():
+    try:
+        model.count_tokens("warmup")
+        app.logger.info("Gemini client warmed up.")
+    except Exception as e:
+        app.logger.warning("Gemini warm-up failed; the first request will pay the setup cost: %s", e)
+
+
+if GEMINI_WARMUP:
+    gevent.spawn(warm_up_gemini)
+
 # Initial insight (optional, just for the welcome page)
-initial_insight = "Gemini is working!"
-try:
-    app.logger.info("Attempting to get initial insight from Gemini.")
-    # Ensure initial insight generation can also use tools if needed, though unlikely for this prompt
-    initial_insight_chat = model.start_chat(history=[])
-    response = initial_insight_chat.send_message("Give me a very short, interesting, and snobby car fact.")
-    initial_insight = response.text
-    app.logger.info("Successfully received initial insight.")
-except Exception as e:
-    app.logger.error(f"Error getting initial insight from Gemini: {e}")
-    initial_insight = f"Professor Torque is currently sulking due to a rare mechanical fault: {e}. Please try again later."
+INITIAL_INSIGHT_PLACEHOLDER = "Professor Torque is still composing his opening remark. Refresh in a moment, if you must."
+INITIAL_INSIGHT_RETRY_SECONDS = 5 * 60
+
+
+class InitialInsight:
+    """The welcome-page car fact, fetched by a single background greenlet and never on the request path.
+
+    Pages show a placeholder until the fetch lands. After a failure the fallback text is served for
+    INITIAL_INSIGHT_RETRY_SECONDS before another attempt, so an outage doesn't cost a Gemini call per view.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._text = INITIAL_INSIGHT_PLACEHOLDER
+        self._ready = False
+        self._fetching = False
+        self._retry_at = 0.0
+
+    def get(self) -> str:
+        """Returns the current text immediately, starting a background fetch if one is due."""
+        with self._lock:
+            if not self._ready and not self._fetching and time.monotonic() >= self._retry_at:
+                self._fetching = True
+                gevent.spawn(self._fetch)
+            return self._text
+
+    def _fetch(self):
+        try:
+            app.logger.info("Attempting to get initial insight from Gemini.")
+            # Ensure initial insight generation can also use tools if needed, though unlikely for this prompt
+            initial_insight_chat = model.start_chat(history=[])
+            with gemini_call(initial_insight_chat.send_message, "Give me a very short, interesting, and snobby car fact.") as response:
+                text, ready = response.text, True
+            app.logger.info("Successfully received initial insight.")
+        except Exception as e:
+            app.logger.error("Error getting initial insight from Gemini: %s", e)
+            text, ready = f"Professor Torque is currently sulking due to a rare mechanical fault: {e}. Please try again later.", False
+        with self._lock:
+            self._text, self._ready, self._fetching = text, ready, False
+            if not ready:
+                self._retry_at = time.monotonic() + INITIAL_INSIGHT_RETRY_SECONDS
+
+
+initial_insight = InitialInsight()
+if GEMINI_WARMUP:
+    initial_insight.get() # Start fetching at import, so it also happens under gunicorn, not just `python app.py`
+
+# --- Chat Session Cache ---
+# Live ChatSession objects keyed by session id, so each turn only appends the new message
+# instead of re-validating and replaying the whole client-supplied history.
+# Server-side history is authoritative: responses carry only the new turn, never the full history.
+# The TTL slides on every use, so only idle sessions expire; a client may still send "history" to rebuild one.
+SESSION_TTL_SECONDS = 30 * 60
+SESSIONS = TTLCache(maxsize=1024, ttl=SESSION_TTL_SECONDS)
+SESSIONS_LOCK = threading.Lock()
+
+
+class CachedSession:
+    """A live ChatSession plus the lock that serializes every turn and history read on it.
+
+    It also keeps the session's text turns already serialized for replay (`turns`) and how many SDK
+    history messages they cover (`synced`), so each turn only serializes the newest messages.
+    """
+    __slots__ = ('chat', 'lock', 'turns', 'synced')
+
+    def __init__(self, chat):
+        self.chat = chat
+        self.lock = threading.Lock()
+        self.turns = []
+        self.synced = 0
+
+
+def get_session(session_id):
+    """Looks up a cached session and refreshes its TTL, so active conversations never expire mid-use."""
+    if not session_id:
+        return None
+    with SESSIONS_LOCK:
+        entry = SESSIONS.get(session_id)
+        if entry is not None:
+            # cachetools only sets the expiry on insert, so re-insert to slide it.
+            SESSIONS[session_id] = entry
+    return entry
+
+# Upper bound on tool-call follow-ups per user message, so a model that keeps requesting tools can't loop forever.
+MAX_TOOL_ROUNDS = 5
+
+# --- Chat Request Schema ---
+# msgspec decodes and validates the whole /chat body in a single C pass, replacing per-item isinstance checks.
+class Turn(msgspec.Struct):
+    """One text-only chat turn as kept in a session's serialized history."""
+    role: Literal['user', 'model']
+    parts: list[str]
+
+
+class TextPart(msgspec.Struct):
+    text: str
+
+
+class HistoryTurn(msgspec.Struct):
+    """One chat turn on the wire, in /chat "history" and /chat/history: parts are {"text": ...} objects.
+
+    For older clients, /chat also accepts a turn's text as a bare string.
+    """
+    role: Literal['user', 'model']
+    parts: Union[list[TextPart], str]
+
+
+class ChatRequest(msgspec.Struct):
+    message: str = ""
+    history: list[HistoryTurn] = []
+    session_id: Optional[str] = None
+
+
+def rewind_turn(session_id: str, entry: CachedSession, sends: int):
+    """Removes the request/response pairs a failed turn added, so the cached session stays usable.
+
+    Drops the session instead if the SDK can't rewind it (e.g. a stream broke before any candidate arrived).
+    """
+    try:
+        for _ in range(sends):
+            entry.chat.rewind()
+        app.logger.info("Rewound %s message pair(s) in chat session %s.", sends, session_id)
+    except Exception as e:
+        app.logger.warning("Could not rewind chat session %s, dropping it: %s", session_id, e)
+        with SESSIONS_LOCK:
+            SESSIONS.pop(session_id, None)
+
+
+def sse_event(payload: dict) -> bytes:
+    """Formats a payload as a single Server-Sent Events message."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+def stream_text(response):
+    """Yields SSE chunk events for each text part of a streamed Gemini response, consuming it fully."""
+    for chunk in response:
+        for part in chunk.parts:
+            if part.text:
+                yield sse_event({"chunk": part.text})
+
+
+def function_calls(response) -> list:
+    """Returns every function call requested in a (fully consumed) Gemini response."""
+    # Proto parts always expose a function_call attribute, so an empty name means "no call".
+    return [part.function_call for part in response.parts if hasattr(part, 'function_call') and part.function_call.name]
+
+
+def run_tool_calls(tool_calls: list) -> list:
+    """Executes each requested function call and returns the FunctionResponse parts answering them."""
+    tool_outputs = []
+    for tool_call in tool_calls:
+        tool_name = tool_call.name
+        tool_args = dict(tool_call.args) # Convert protobuf map to Python dict
+
+        app.logger.info("Gemini requested tool call: %s with args: %s", tool_name, tool_args)
+
+        # Execute the tool function registered under its name
+        tool_fn = TOOL_REGISTRY.get(tool_name)
+        if tool_fn:
+            tool_output = tool_fn(**tool_args)
+        else:
+            tool_output = f"Unknown tool: {tool_name}"
+            app.logger.error(tool_output)
+        tool_outputs.append(genai.protos.Part(
+            function_response=genai.protos.FunctionResponse(name=tool_name, response={"result": tool_output})
+        ))
+    return tool_outputs
+
+
+def serialize_message(msg) -> Turn:
+    """Converts one chat history message into a Turn holding its text parts."""
+    return Turn(role=msg.role, parts=[part.text for part in msg.parts if part.text])
+
+
+def to_wire(turn: Turn) -> HistoryTurn:
+    return HistoryTurn(role=turn.role, parts=[TextPart(text) for text in turn.parts])
+
+
+def to_content(turn: HistoryTurn) -> genai.protos.Content:
+    """Builds the Gemini proto for a client-supplied turn when a session is rebuilt from its history."""
+    texts = [turn.parts] if isinstance(turn.parts, str) else [part.text for part in turn.parts]
+    return genai.protos.Content(role=turn.role, parts=[genai.protos.Part(text=text) for text in texts])
+
+
+def serialized_history(entry: CachedSession) -> list:
+    """Returns the session's text turns, serializing only the messages added since the last call.
+
+    Function calls and tool responses carry no text and are left out, which keeps the replay valid as
+    /chat "history" input. Callers must hold entry.lock.
+    """
+    history = entry.chat.history
+    for msg in history[entry.synced:]:
+        turn = serialize_message(msg)
+        if turn.parts:
+            entry.turns.append(turn)
+    entry.synced = len(history)
+    return entry.turns
+
+
+# --- Batch Chat Service ---
+# An async job runner for non-interactive callers (e.g. evaluators) that submit many prompts at once:
+# callers get a job id back and poll for results. It saves no cost and no round-trips: the pinned SDK has no
+# Gemini Batch API, so each prompt is still its own full-price call until the SDK is upgraded.
+MAX_BATCH_PROMPTS = 100
+# Prompts accepted but not yet answered, across all jobs; submissions beyond this are turned away.
+MAX_PENDING_BATCH_PROMPTS = int(os.getenv('GEMINI_MAX_PENDING_BATCH_PROMPTS', '500'))
+# Batch prompts get their own, smaller share of upstream calls, so a large job can't take every
+# GEMINI_INFLIGHT slot from interactive /chat traffic.
+GEMINI_MAX_BATCH_INFLIGHT = int(os.getenv('GEMINI_MAX_BATCH_INFLIGHT', '4'))
+BATCH_INFLIGHT = BoundedSemaphore(GEMINI_MAX_BATCH_INFLIGHT)
+
+
+class BatchJobService:
+    """Runs submitted prompts in the background and keeps their results for polling."""
+
+    def __init__(self):
+        self.jobs = TTLCache(maxsize=4096, ttl=SESSION_TTL_SECONDS)
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, prompts: list) -> Optional[str]:
+        """Starts answering prompts as one job and returns its id, or None if the service is at capacity."""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if self.pending + len(prompts) > MAX_PENDING_BATCH_PROMPTS:
+                return None
+            self.pending += len(prompts)
+            self.jobs[job_id] = {"status": "pending", "remaining": len(prompts), "results": [None] * len(prompts)}
+        # One greenlet per prompt, so a slow answer never holds up the others; BATCH_INFLIGHT bounds how
+        # many are actually calling Gemini.
+        for i, prompt in enumerate(prompts):
+            gevent.spawn(self._answer, job_id, i, prompt)
+        return job_id
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self.jobs.get(job_id)
 
+    def _answer(self, job_id: str, index: int, prompt: str):
+        try:
+            with BATCH_INFLIGHT:
+                result = {"prompt": prompt, "response": self._ask(prompt)}
+        except Exception as e:
+            app.logger.error("Error answering batched prompt for job %s: %s", job_id, e)
+            result = {"prompt": prompt, "error": str(e)}
+        with self._lock:
+            self.pending -= 1
+            job = self.jobs.get(job_id)
+            if job is None: # Expired before completion; nobody can poll for it anymore
+                return
+            job["results"][index] = result
+            job["remaining"] -= 1
+            if job["remaining"] == 0:
+                job["status"] = "done"
+
+
+    @staticmethod
+    def _ask(prompt: str) -> str:
+        """Answers one prompt in a throwaway chat, running the same tool loop as /chat."""
+        chat = model.start_chat(history=[])
+        content = prompt
+        for _ in range(MAX_TOOL_ROUNDS + 1):
+            with gemini_call(chat.send_message, content) as response:
+                tool_calls = function_calls(response)
+                if not tool_calls:
+                    # Not response.text: it raises unless the reply is exactly one text part.
+                    return "".join(part.text for part in response.parts if part.text)
+            content = run_tool_calls(tool_calls)
+        raise RuntimeError(f"Gemini still requested tool calls after {MAX_TOOL_ROUNDS} rounds")
+
+
+batch_service = BatchJobService()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    app.logger.warning("Rejecting request over %s bytes to %s", MAX_REQUEST_BYTES, request.path)
+    return jsonify({"response": "Professor Torque does not read novels. Keep your transmission concise."}), 413
 
 @app.route('/')
 def index():
     app.logger.info("Accessed index page.")
-    return render_template('index.html', initial_insight=initial_insight)
+    return render_template('index.html', initial_insight=initial_insight.get())
 
 @app.route('/chat', methods=['POST'])
 def chat():
-    user_message = request.json.get('message')
-    raw_history = request.json.get('history', [])
+    try:
+        chat_request = msgspec.json.decode(request.get_data(cache=False), type=ChatRequest)
+    except msgspec.DecodeError as e: # Also covers schema validation failures
+        app.logger.error("Invalid chat request: %s", e)
+        return jsonify({
+            "response": "Professor Torque couldn't quite comprehend your garbled transmission. Ensure your data is properly formatted, please."
+        }), 400
+
+    user_message = chat_request.message
+    session_id = chat_request.session_id
 
-    app.logger.info(f"Received chat request. User message: '{user_message}'")
-    app.logger.debug(f"Raw history received: {raw_history}")
+    app.logger.info("Received chat request. User message: '%s'", user_message)
+    app.logger.debug("History received: %s", chat_request.history)
 
     if not user_message:
         app.logger.warning("No message provided in chat request.")
-        return jsonify({"response": "Professor Torque demands proper questions, not silence.", "history": raw_history}), 400
+        return jsonify({"response": "Professor Torque demands proper questions, not silence.", "session_id": session_id}), 400
 
-    try:
-        processed_history = []
-        for item in raw_history:
-            if 'role' in item and 'parts' in item:
-                if isinstance(item['parts'], list) and all(isinstance(p, dict) and 'text' in p for p in item['parts']):
-                    processed_history.append({'role': item['role'], 'parts': item['parts']})
-                elif isinstance(item['parts'], str):
-                    processed_history.append({'role': item['role'], 'parts': [{'text': item['parts']}]})
+    # The reply is streamed as Server-Sent Events: a {"chunk": ...} event per piece of text,
+    # then a terminal {"done": true, ...} event carrying the session id and the new turn's index.
+    # Once streaming has started the status code is fixed, so errors arrive as an {"error": ...} event.
+    def generate(session_id):
+        try:
+            entry = get_session(session_id)
+            # The client sent an id we no longer hold: its earlier context is gone, so tell it.
+            session_expired = bool(session_id) and entry is None
+            # A new session is only cached once its first turn completes, so a failed first turn (whose
+            # error event carries no session id) doesn't leave an orphan behind.
+            is_new_session = entry is None
+
+            if entry is not None:
+                app.logger.info("Reusing cached chat session %s.", session_id)
             else:
-                app.logger.warning(f"Skipping malformed history item: {item}")
+                # Cache miss (new conversation or expired session): rebuild from the client's history,
+                # which msgspec has already validated.
+                processed_history = [to_content(turn) for turn in chat_request.history]
 
-        # Initialize chat with the full history and the tools
-        # Crucially, the 'tools' argument is passed here as well.
-        chat = model.start_chat(history=processed_history, tools=[get_car_info_tool])
+                # Initialize chat with the full history. The tools were registered once on the model,
+                # so they are not re-passed (and re-serialized) for every new session.
+                entry = CachedSession(model.start_chat(history=processed_history))
+                session_id = uuid.uuid4().hex
+                app.logger.info("Started new chat session %s.", session_id)
 
-        app.logger.info("Sending message to Gemini API...")
-        response = chat.send_message(user_message)
-        app.logger.info("Received response from Gemini API.")
+            # One turn at a time per session: a concurrent turn or history read would otherwise see
+            # (and could persist) a partially received response.
+            with entry.lock:
+                chat = entry.chat
+                # Request/response pairs this turn has added to the session. If the turn fails or the
+                # client disconnects part-way, they are rewound so later turns don't inherit a broken state.
+                recorded_sends = 0
+                try:
+                    app.logger.info("Streaming message to Gemini API...")
+                    # The slot is held until the stream is fully consumed, since that's when the upstream call ends.
+                    with gemini_call(chat.send_message, user_message, stream=True) as response:
+                        recorded_sends += 1
+                        yield from stream_text(response)
+                    app.logger.info("Received response from Gemini API.")
 
-        # --- Function Calling Logic ---
-        # Check if the model's response contains a function call
-        if response.parts and hasattr(response.parts[0], 'function_call'):
-            tool_call = response.parts[0].function_call
-            tool_name = tool_call.name
-            tool_args = {k: v for k, v in tool_call.args.items()} # Convert protobuf map to Python dict
+                    # --- Function Calling Logic ---
+                    # Answer every function call in a response with one follow-up message (rather than
+                    # one round-trip per call), and repeat until Gemini stops asking for tools.
+                    tool_calls = function_calls(response)
+                    tool_rounds = 0
+                    while tool_calls and tool_rounds < MAX_TOOL_ROUNDS:
+                        tool_rounds += 1
+                        tool_outputs = run_tool_calls(tool_calls)
 
-            app.logger.info(f"Gemini requested tool call: {tool_name} with args: {tool_args}")
+                        # Send all tool outputs back to Gemini at once and stream its natural language response
+                        app.logger.info("Sending %s tool output(s) back to Gemini.", len(tool_outputs))
+                        with gemini_call(chat.send_message, tool_outputs, stream=True) as response:
+                            recorded_sends += 1
+                            yield from stream_text(response)
+                        app.logger.info("Received response from Gemini after tool execution.")
+                        tool_calls = function_calls(response)
 
-            # Execute the tool function based on its name
-            if tool_name == "get_car_info":
-                # Call the actual Python function
-                tool_output = get_car_info(**tool_args)
-            else:
-                tool_output = f"Unknown tool: {tool_name}"
-                app.logger.error(tool_output)
-
-            # Send the tool output back to Gemini to get a natural language response
-            app.logger.info(f"Sending tool output back to Gemini: {tool_output}")
-            response = chat.send_message(
-                genai.types.ToolOutput(tool_code=tool_name, content=tool_output)
-            )
-            app.logger.info("Received final response from Gemini after tool execution.")
-        # --- End Function Calling Logic ---
-
-
-        json_history = []
-        for msg in chat.history:
-            parts_list = []
-            for part in msg.parts:
-                if hasattr(part, 'text'):
-                    parts_list.append({'text': part.text})
-                elif hasattr(part, 'function_call'): # Capture function calls in history if needed for debugging/display
-                    parts_list.append({
-                        'function_call': {
-                            'name': part.function_call.name,
-                            'args': {k: v for k, v in part.function_call.args.items()}
-                        }
-                    })
-                elif hasattr(part, 'tool_response'): # Capture tool responses
-                    parts_list.append({
-                        'tool_response': {
-                            'tool_code': part.tool_response.tool_code,
-                            'content': part.tool_response.content
-                        }
+                    if tool_calls:
+                        # Still asking for tools after MAX_TOOL_ROUNDS. Leaving the calls unanswered would break
+                        # every later turn, so give up on this one; the finally below rewinds it entirely.
+                        app.logger.error("Gemini still requested %s tool call(s) after %s rounds; abandoning the turn.", len(tool_calls), MAX_TOOL_ROUNDS)
+                        yield sse_event({
+                            "error": "Professor Torque became hopelessly lost in his own research. Do ask again, perhaps more simply.",
+                            "status": 500
+                        })
+                        return
+                    # --- End Function Calling Logic ---
+
+                    # Indexes into the /chat/history replay. Reading history also surfaces a stream that
+                    # broke or was stopped (e.g. for SAFETY), which the finally below then rewinds. A final
+                    # reply without text is left out of the replay, so it gets no index.
+                    turns = serialized_history(entry)
+                    reply_has_text = any(part.text for part in chat.history[-1].parts)
+                    turn_index = len(turns) - 1 if reply_has_text else None
+                    recorded_sends = 0 # The turn is complete; nothing to undo from here on
+                    if is_new_session:
+                        with SESSIONS_LOCK:
+                            SESSIONS[session_id] = entry
+                    yield sse_event({
+                        "done": True,
+                        "session_id": session_id,
+                        "turn_index": turn_index,
+                        "session_expired": session_expired
                     })
-            json_history.append({'role': msg.role, 'parts': parts_list})
+                finally:
+                    if recorded_sends and not is_new_session: # An uncached new session is simply discarded
+                        rewind_turn(session_id, entry, recorded_sends)
+        except genai.types.BlockedPromptException as e:
+            app.logger.warning("Gemini API blocked prompt: %s", e)
+            yield sse_event({
+                "error": "Professor Torque finds your language utterly unrefined. Please rephrase your query.",
+                "status": 400
+            })
+        except google_exceptions.ResourceExhausted as e:
+            app.logger.error("Gemini API quota exhausted: %s", e)
+            yield sse_event({
+                "error": f"Professor Torque's precious API quota has been temporarily exhausted. Such a commoner's problem! Please wait a moment. ({e})",
+                "status": 429
+            })
+        except google_exceptions.GoogleAPIError as e:
+            app.logger.error("Gemini API error: %s", e)
+            yield sse_event({
+                "error": f"Professor Torque is experiencing a rare technical glitch. Perhaps the 'internet' is not as robust as proper engineering: {e}",
+                "status": 500
+            })
+        except Exception as e:
+            app.logger.critical("An unexpected error occurred during chat: %s", e, exc_info=True)
+            yield sse_event({
+                "error": f"Professor Torque's circuit board is momentarily bewildered by an unforeseen anomaly: {e}. Such a nuisance!",
+                "status": 500
+            })
 
-        return jsonify({"response": response.text, "history": json_history})
+    return Response(
+        stream_with_context(generate(session_id)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-    except genai.types.BlockedPromptException as e:
-        app.logger.warning(f"Gemini API blocked prompt: {e}")
-        return jsonify({
-            "response": "Professor Torque finds your language utterly unrefined. Please rephrase your query.",
-            "history": raw_history
-        }), 400
-    except genai.types.ClientError as e:
-        app.logger.error(f"Gemini API client error: {e}")
-        # Check for 429 specifically for more tailored message
-        if "429" in str(e):
-            return jsonify({
-                "response": f"Professor Torque's precious API quota has been temporarily exhausted. Such a commoner's problem! Please wait a moment. ({e})",
-                "history": raw_history
-            }), 429
-        return jsonify({
-            "response": f"Professor Torque is experiencing a rare technical glitch. Perhaps the 'internet' is not as robust as proper engineering: {e}",
-            "history": raw_history
-        }), 500
-    except json.JSONDecodeError as e:
-        app.logger.error(f"JSON decoding error in chat request: {e}")
-        return jsonify({
-            "response": "Professor Torque couldn't quite comprehend your garbled transmission. Ensure your data is properly formatted, please.",
-            "history": raw_history
-        }), 400
-    except Exception as e:
-        app.logger.critical(f"An unexpected error occurred during chat: {e}", exc_info=True)
-        return jsonify({
-            "response": f"Professor Torque's circuit board is momentarily bewildered by an unforeseen anomaly: {e}. Such a nuisance!",
-            "history": raw_history
-        }), 500
+@app.route('/chat/history', methods=['GET'])
+def chat_history():
+    """Replays a session's full history for clients that need it; /chat itself only returns the new turn."""
+    session_id = request.args.get('session_id')
+    entry = get_session(session_id)
+
+    if entry is None:
+        app.logger.warning("History requested for unknown or expired session: %s", session_id)
+        return jsonify({"response": "Professor Torque has no recollection of this conversation. Do try to be more memorable."}), 404
+
+    with entry.lock: # Wait for any in-flight turn, so a partial response is never serialized
+        history = [to_wire(turn) for turn in serialized_history(entry)]
+    return Response(msgspec.json.encode({"session_id": session_id, "history": history}), mimetype='application/json')
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Queues a list of independent prompts to be answered in the background; poll GET /chat/batch/<job_id> for results."""
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError as e:
+        app.logger.error("JSON decoding error in batch request: %s", e)
+        data = None
+    prompts = data.get('prompts') if isinstance(data, dict) else None
+
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p for p in prompts):
+        app.logger.warning("Malformed batch request.")
+        return jsonify({"response": "Professor Torque expects a non-empty list of proper questions under 'prompts'."}), 400
+    if len(prompts) > MAX_BATCH_PROMPTS:
+        return jsonify({"response": f"Professor Torque will entertain at most {MAX_BATCH_PROMPTS} questions at once."}), 413
+
+    job_id = batch_service.submit(prompts)
+    if job_id is None:
+        app.logger.warning("Batch queue full; rejecting %s prompt(s).", len(prompts))
+        return jsonify({"response": "Professor Torque's lecture hall is full. Submit your questions again later."}), 503
+    app.logger.info("Queued batch job %s with %s prompt(s).", job_id, len(prompts))
+    return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+@app.route('/chat/batch/<job_id>', methods=['GET'])
+def chat_batch_status(job_id):
+    job = batch_service.get(job_id)
+    if job is None:
+        return jsonify({"response": "Professor Torque has no record of that batch. Perhaps it was too dull to remember."}), 404
+    return jsonify({"job_id": job_id, "status": job["status"], "results": job["results"]})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Serve with gevent's WSGI server rather than the Werkzeug dev server, so many
+    # slow Gemini round-trips can be in flight at once on a single worker.
+    # In production, prefer: gunicorn -k gevent --worker-connections 1000 app:app
+    app.logger.info("Starting gevent WSGI server on 0.0.0.0:5000.")
+    WSGIServer(('0.0.0.0', 5000), app).serve_forever()
\ No newline at end of file
@@ -0,0 +1,212 @@
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import orjson
+import pytest
+import tenacity
+from google.api_core import exceptions as google_exceptions
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ["GEMINI_WARMUP"] = "0" # No background Gemini calls at import; they would race the mocked model
+
+import app as app_module  # noqa: E402 (the environment must be set before import)
+
+
+def text_part(text):
+    return SimpleNamespace(text=text, function_call=SimpleNamespace(name="", args={}))
+
+
+def call_part(name, **args):
+    return SimpleNamespace(text="", function_call=SimpleNamespace(name=name, args=args))
+
+
+class FakeResponse:
+    """A streamed Gemini response delivered as a single chunk carrying every part."""
+
+    def __init__(self, *parts):
+        self.parts = list(parts)
+
+    def __iter__(self):
+        yield self
+
+
+class FakeChat:
+    """Stands in for a ChatSession: replays canned responses and records what was sent."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.history = []
+        self.rewinds = 0
+
+    def send_message(self, content, stream=False):
+        self.sent.append(content)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        user_parts = [text_part(content)] if isinstance(content, str) else []
+        self.history += [SimpleNamespace(role="user", parts=user_parts), SimpleNamespace(role="model", parts=response.parts)]
+        return response
+
+    def rewind(self):
+        self.rewinds += 1
+
+
+@pytest.fixture
+def client():
+    app_module.SESSIONS.clear()
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def fake_model():
+    with mock.patch.object(app_module, "model") as model:
+        yield model
+
+
+def post_chat(client, **body):
+    response = client.post("/chat", data=orjson.dumps(body), content_type="application/json")
+    events = [orjson.loads(event[len(b"data: "):]) for event in response.data.split(b"\n\n") if event]
+    return response, events
+
+
+def test_get_car_info_matches_on_first_words():
+    assert "Porsche 911" in app_module.get_car_info("Porsche", "911 Carrera S")
+    assert "no significant data" in app_module.get_car_info("Lada", "Niva")
+
+
+def test_function_call_is_executed_and_answered(client, fake_model):
+    chat = FakeChat(
+        FakeResponse(call_part("get_car_info", make="Porsche", model="911")),
+        FakeResponse(text_part("Naturally, a 911.")),
+    )
+    fake_model.start_chat.return_value = chat
+
+    response, events = post_chat(client, message="Tell me about the Porsche 911")
+
+    assert response.status_code == 200
+    # Tools are registered on the model, not re-passed per session
+    fake_model.start_chat.assert_called_once_with(history=[])
+
+    tool_outputs = chat.sent[1]
+    assert len(tool_outputs) == 1
+    function_response = app_module.genai.protos.Part.to_dict(tool_outputs[0])["function_response"]
+    assert function_response["name"] == "get_car_info"
+    assert "Porsche 911" in function_response["response"]["result"]
+
+    assert [e["chunk"] for e in events if "chunk" in e] == ["Naturally, a 911."]
+    done = events[-1]
+    assert done["done"] is True
+    assert done["turn_index"] == 1 # user message, then the model's text reply; tool turns carry no text
+    assert done["session_id"] in app_module.SESSIONS
+    assert chat.rewinds == 0
+
+
+def test_history_uses_text_part_objects_on_the_wire(client, fake_model):
+    chat = FakeChat(FakeResponse(text_part("Still a Camry.")))
+    fake_model.start_chat.return_value = chat
+    history = [
+        {"role": "user", "parts": [{"text": "I drive a Camry."}]},
+        {"role": "model", "parts": "How dreary."}, # bare strings are still accepted
+    ]
+
+    _, events = post_chat(client, message="Any better now?", history=history)
+
+    rebuilt = [app_module.genai.protos.Content.to_dict(c) for c in fake_model.start_chat.call_args.kwargs["history"]]
+    assert rebuilt == [
+        {"role": "user", "parts": [{"text": "I drive a Camry."}]},
+        {"role": "model", "parts": [{"text": "How dreary."}]},
+    ]
+    replay = client.get("/chat/history", query_string={"session_id": events[-1]["session_id"]}).get_json()
+    assert replay["history"] == [
+        {"role": "user", "parts": [{"text": "Any better now?"}]},
+        {"role": "model", "parts": [{"text": "Still a Camry."}]},
+    ]
+
+
+def test_reply_without_text_has_no_turn_index(client, fake_model):
+    chat = FakeChat(FakeResponse(text_part("")))
+    fake_model.start_chat.return_value = chat
+
+    _, events = post_chat(client, message="...")
+
+    done = events[-1]
+    assert done["done"] is True
+    assert done["turn_index"] is None # the empty reply is not in the /chat/history replay
+
+
+def test_tool_round_limit_abandons_the_turn(client, fake_model):
+    rounds = app_module.MAX_TOOL_ROUNDS + 1
+    chat = FakeChat(*[FakeResponse(call_part("get_car_info", make="Toyota", model="Camry")) for _ in range(rounds)])
+    fake_model.start_chat.return_value = chat
+
+    _, events = post_chat(client, message="Camry?")
+
+    assert "error" in events[-1]
+    assert chat.rewinds == 0 # A failed first turn is discarded with its session, not rewound
+    assert not app_module.SESSIONS
+
+
+def test_tool_round_limit_rewinds_the_turn_of_a_cached_session(client, fake_model):
+    rounds = app_module.MAX_TOOL_ROUNDS + 1
+    chat = FakeChat(
+        FakeResponse(text_part("Ask me something worthwhile.")),
+        *[FakeResponse(call_part("get_car_info", make="Toyota", model="Camry")) for _ in range(rounds)],
+    )
+    fake_model.start_chat.return_value = chat
+    _, events = post_chat(client, message="Hello")
+    session_id = events[-1]["session_id"]
+
+    _, events = post_chat(client, message="Camry?", session_id=session_id)
+
+    assert "error" in events[-1]
+    assert chat.rewinds == rounds
+    assert session_id in app_module.SESSIONS
+
+
+def test_quota_error_is_reported_without_rewinding(client, fake_model):
+    chat = FakeChat(*[google_exceptions.ResourceExhausted("quota") for _ in range(4)])
+    fake_model.start_chat.return_value = chat
+
+    with mock.patch.object(app_module._acquire_and_call.retry, "wait", tenacity.wait_none()):
+        _, events = post_chat(client, message="Hello?")
+
+    assert events[-1]["status"] == 429
+    assert len(chat.sent) == 4 # retried until tenacity gave up
+    assert chat.rewinds == 0
+    assert "session_id" not in events[-1]
+    assert not app_module.SESSIONS # The failed first turn's session was never cached
+
+
+def wait_for_batch(client, job_id):
+    for _ in range(100):
+        job = client.get(f"/chat/batch/{job_id}").get_json()
+        if job["status"] == "done":
+            return job
+        app_module.gevent.sleep(0.01)
+    raise AssertionError("batch job did not finish")
+
+
+def test_batch_prompt_runs_the_tool_loop(client, fake_model):
+    chat = FakeChat(
+        FakeResponse(call_part("get_car_info", make="Ferrari", model="458")),
+        FakeResponse(text_part("A 458, "), text_part("how refreshing.")),
+    )
+    fake_model.start_chat.return_value = chat
+
+    response = client.post("/chat/batch", json={"prompts": ["Thoughts on the Ferrari 458?"]})
+    assert response.status_code == 202
+
+    job = wait_for_batch(client, response.get_json()["job_id"])
+    assert job["results"] == [{"prompt": "Thoughts on the Ferrari 458?", "response": "A 458, how refreshing."}]
+    assert "Ferrari 458" in app_module.genai.protos.Part.to_dict(chat.sent[1][0])["function_response"]["response"]["result"]
+    assert app_module.batch_service.pending == 0
+
+
+def test_batch_is_rejected_when_the_queue_is_full(client, fake_model):
+    with mock.patch.object(app_module, "MAX_PENDING_BATCH_PROMPTS", 1):
+        response = client.post("/chat/batch", json={"prompts": ["Why?", "Why not?"]})
+
+    assert response.status_code == 503
+    fake_model.start_chat.assert_not_called()